@@ -1,14 +1,45 @@
-from fastapi import FastAPI, HTTPException, Body, WebSocket
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, Body, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from starlette.responses import FileResponse
 from pydantic import BaseModel
-import requests
-from datetime import datetime
-import json
+import asyncio
+import logging
+from collections import defaultdict
+import httpx
+import ijson
+from cachetools import TTLCache
+from spot_matcher import best_spot as match_best_spot, EV, DIS, FEM
+from datetime import datetime, timezone
+import orjson
 
 
-app = FastAPI(title="Smart Parking Mission Control")
+logger = logging.getLogger(__name__)
+
+
+# Shared async client for every Orion call. Created once at startup so
+# requests reuse pooled keep-alive connections instead of blocking the
+# event loop (and the machine websockets) on a fresh connection each time.
+client: httpx.AsyncClient = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(
+        base_url=ORION_URL,
+        headers={"Accept": "application/ld+json"},
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    yield
+    await client.aclose()
+
+
+# Caps how many PATCHes a bulk operation keeps in flight against Orion
+orion_write_slots = asyncio.Semaphore(16)
+
+
+app = FastAPI(title="Smart Parking Mission Control", lifespan=lifespan)
 
 # Allows index.html to call this API whether it's opened as a local file,
 # served from a different port, or hosted elsewhere. Read/write behavior
@@ -22,7 +53,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-ORION_URL = "http://127.0.0.1:1026/ngsi-ld/v1/entities"
+# The shared client is rooted at ORION_URL, so every call below passes only
+# a path and reuses the same pooled keep-alive connections.
+ORION_URL = "http://127.0.0.1:1026"
+ENTITIES_PATH = "/ngsi-ld/v1/entities"
+BATCH_DELETE_PATH = "/ngsi-ld/v1/entityOperations/delete"
+
+def status_update(status):
+    """Builds the NGSI-LD attrs PATCH body that sets a spot's status"""
+    return {
+        "status": {
+            "type": "Property",
+            "value": status
+        },
+        "occupancyModified": {
+            "type": "Property",
+            "value": {
+                "@type": "DateTime",
+                "@value": "2023-10-27T12:00:00Z"
+            }
+        }
+    }
+
+# The status PATCH bodies never change, so serialize them once up front
+OCCUPIED_BODY = orjson.dumps(status_update("occupied"))
+FREE_BODY = orjson.dumps(status_update("free"))
+
+def fiware_update_failed(response):
+    """
+    Builds the error for a rejected status PATCH. Orion's error body is only
+    decoded when debug logging is on, since clients never see it.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("FIWARE rejected update (%s): %s", response.status_code, response.text)
+    return HTTPException(status_code=400, detail="FIWARE update failed")
 
 class BookingRequest(BaseModel):
     requires_disabled: bool = False
@@ -39,18 +103,142 @@ def get_clean_value(attribute):
 
     return attribute
 
+# Spot coordinates never change once registered, so /book-spot keeps them
+# per spot id instead of fetching the entity again. Dropped on deletion.
+coords_cache: dict[str, list] = {}
+
+class AsyncByteReader:
+    """Adapts an async byte iterator to the async read() ijson expects"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def read(self, size=-1):
+        if size == 0:
+            return b""
+        # ijson treats an empty read as end of stream, so skip empty chunks
+        async for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b""
+
+# Short-lived copies of Orion spot listings, keyed by the NGSI-LD `q` filter
+# ("all_spots" for the unfiltered listing). Bursts of /find-spot or
+# dashboard polls within the TTL share one Orion round-trip; every write
+# below calls invalidate_spots() so the next read sees fresh state.
+spots_cache = TTLCache(maxsize=16, ttl=2.0)
+# One lock per cache key, so a slow miss on one filter doesn't hold up
+# misses on the others (or the dashboard's unfiltered listing)
+spots_cache_locks = defaultdict(asyncio.Lock)
+# Bumped on every write. A refill only stores its result if no write landed
+# while its GET was in flight, otherwise it could cache the pre-write state.
+spots_generation = 0
+
+def invalidate_spots():
+    """Drops cached listings after a write to Orion"""
+    global spots_generation
+    spots_generation += 1
+    spots_cache.clear()
+
+async def fetch_spots(q=None):
+    """Returns the SmartIndoorParkingSpots matching `q`, served from the cache when fresh"""
+    key = q or "all_spots"
+    spots = spots_cache.get(key)
+    if spots is not None:
+        return spots
+
+    async with spots_cache_locks[key]:
+        # Another request may have refilled the cache while we waited
+        spots = spots_cache.get(key)
+        if spots is not None:
+            return spots
+
+        params = {"type": "SmartIndoorParkingSpot"}
+        if q:
+            params["q"] = q
+        generation = spots_generation
+
+        try:
+            # Parse spots straight off the wire instead of buffering the whole
+            # body first; large garages never hold both copies in memory.
+            async with client.stream(
+                "GET",
+                ENTITIES_PATH,
+                params=params
+            ) as response:
+                response.raise_for_status()
+                reader = AsyncByteReader(response.aiter_bytes())
+                spots = [
+                    spot async for spot in ijson.items_async(reader, "item", use_float=True)
+                ]
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
+
+        if generation == spots_generation:
+            spots_cache[key] = spots
+        return spots
+
+def build_spot_query(preferences):
+    """
+    Builds the NGSI-LD `q` filter so Orion only returns free spots whose
+    special categories match the request exactly (see find_parking_spot).
+    """
+    clauses = ['status=="free"']
+    for category, requested in (
+        (EV, preferences.requires_ev),
+        (DIS, preferences.requires_disabled),
+        (FEM, preferences.requires_female),
+    ):
+        clauses.append(f'category{"==" if requested else "!="}"{category}"')
+    return ";".join(clauses)
+
 class ConnectionManager:
+    # Broadcasts a machine hasn't picked up yet. A client that falls this far
+    # behind is dropped rather than letting its backlog grow without bound.
+    MAX_PENDING = 32
+
     def __init__(self):
-        # Store active machine connections
-        self.active_connections: list[WebSocket] = []
+        # Store active machine connections, each with its outgoing queue
+        self.active_connections: dict[WebSocket, asyncio.Queue] = {}
+        self.writers: dict[WebSocket, asyncio.Task] = {}
+        # Pending close tasks; held here so they aren't garbage-collected
+        # before the close frame is sent
+        self.closing: set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.MAX_PENDING)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
         print("Machine connected to Mission Control")
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # Safe to call for a socket a failed broadcast already dropped
+        self._drop(websocket)
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Drains one machine's queue onto its socket"""
+        try:
+            while True:
+                text = await queue.get()
+                await websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A socket that failed to send is dead; stop broadcasting to it
+            print(f"Dropped machine connection after failed send: {e!r}")
+            self._drop(websocket)
+
+    def _drop(self, websocket: WebSocket):
+        self.active_connections.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+
+    async def _close(self, websocket: WebSocket):
+        # 1013 "Try Again Later": the machine may reconnect and resync
+        with suppress(Exception):
+            await websocket.close(code=1013)
 
     async def send_coordinates(self, spot_id: str, coordinates: list):
         """Sends the target coordinates to all connected machines"""
@@ -58,10 +246,20 @@ class ConnectionManager:
             "event": "NEW_BOOKING",
             "spot_id": spot_id,
             "coordinates": coordinates,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now(timezone.utc)
         }
-        for connection in self.active_connections:
-            await connection.send_json(payload)
+        # Serialize once and hand the text to each machine's writer task, so
+        # one slow client never holds up the others or the booking request.
+        text = orjson.dumps(payload, option=orjson.OPT_UTC_Z).decode()
+        for websocket, queue in list(self.active_connections.items()):
+            try:
+                queue.put_nowait(text)
+            except asyncio.QueueFull:
+                print("Dropped machine connection: too many unsent broadcasts")
+                self._drop(websocket)
+                task = asyncio.create_task(self._close(websocket))
+                self.closing.add(task)
+                task.add_done_callback(self.closing.discard)
 
 manager = ConnectionManager()
 
@@ -81,82 +279,33 @@ async def machine_socket(websocket: WebSocket):
         print("Machine disconnected")
 
 @app.post("/find-spot")
-def find_parking_spot(preferences: BookingRequest):
+async def find_parking_spot(preferences: BookingRequest):
     """
     Finds the best parking spot based on user preferences.
     """
 
-    try:
-        response = requests.get(
-            f"{ORION_URL}?type=SmartIndoorParkingSpot",
-            headers={"Accept": "application/ld+json"}
-        )
-        response.raise_for_status()
-        all_spots = response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
+    # Orion does the filtering; spot_matcher only ranks what comes back
+    # (and guards against brokers that evaluate `q` on arrays differently).
+    all_spots = await fetch_spots(build_spot_query(preferences))
 
+    best_spot, _ = match_best_spot(
+        all_spots,
+        preferences.requires_ev,
+        preferences.requires_disabled,
+        preferences.requires_female,
+    )
 
-    suitable_spots = []
-
-    for spot in all_spots:
-
-        spot_id = spot.get("id")
-
-        status = get_clean_value(spot.get("status"))
-        categories = get_clean_value(spot.get("category")) or []
-        # Orion can return category as a single string OR a list — normalize it
-        if not isinstance(categories, list):
-            categories = [categories]
-
-        if status != "free":
-            continue
-
-        has_ev = "forElectricCharging" in categories
-        has_disabled = "forDisabled" in categories
-        has_women = "forWomen" in categories
-
-        spot_weight = int(has_ev) + int(has_disabled) + int(has_women)
-
-        # A spot matches only if EACH special category either:
-        #   - was requested and the spot has it, or
-        #   - was NOT requested and the spot does NOT have it.
-        # This is what makes the three categories behave symmetrically:
-        # requesting "general" (nothing) should never match an EV spot,
-        # a women's spot, or an accessible spot — and requesting "women only"
-        # should never match a women's spot that's ALSO an EV spot.
-        is_match = (
-            (has_ev == preferences.requires_ev) and
-            (has_disabled == preferences.requires_disabled) and
-            (has_women == preferences.requires_female)
-        )
-
-        if is_match:
-            suitable_spots.append((spot, spot_weight))
-
-
-    if not suitable_spots:
+    if best_spot is None:
         return {"status": "failure", "message": "No suitable spots available."}
 
 
-    best_spot = None
-    min_weight = float("inf")
-    min_spot_number = float("inf")
-
-    for spot, weight in suitable_spots:
-        raw_spot_number = get_clean_value(spot.get("spotNumber"))
-        try:
-            spot_number = int(raw_spot_number)
-        except (TypeError, ValueError):
-            spot_number = float("inf")
-        if weight < min_weight or (weight == min_weight and spot_number < min_spot_number):
-            min_weight = weight
-            min_spot_number = spot_number
-            best_spot = spot
-
-
     location_data = get_clean_value(best_spot.get("location"))
-    coordinates = location_data.get("coordinates") if location_data else [0,0]
+    coordinates = location_data.get("coordinates") if location_data else None
+    if coordinates is not None:
+        # Remember them so the follow-up /book-spot can skip its GET
+        coords_cache[best_spot.get("id")] = coordinates
+    else:
+        coordinates = [0,0]
 
     return {
         "status": "success",
@@ -167,21 +316,13 @@ def find_parking_spot(preferences: BookingRequest):
     }
 
 @app.get("/all-spots")
-def get_all_spots():
+async def get_all_spots():
     """
     Read-only endpoint added purely to power the new dashboard grid.
     Does NOT modify any Digital Twin state — just reflects it.
     Returns spot number, status, and category for every SmartIndoorParkingSpot.
     """
-    try:
-        response = requests.get(
-            f"{ORION_URL}?type=SmartIndoorParkingSpot",
-            headers={"Accept": "application/ld+json"}
-        )
-        response.raise_for_status()
-        all_spots = response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
+    all_spots = await fetch_spots()
 
     spots_summary = []
     for spot in all_spots:
@@ -214,45 +355,30 @@ async def book_parking_spot(booking: BookingConfirmation):
     """
     spot_id = booking.spot_id
 
-    try:
-        response = requests.get(
-            f"{ORION_URL}/{spot_id}",
-            headers={"Accept": "application/ld+json"}
-        )
-        response.raise_for_status()
-        response = response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
-
-    try:
-        coords = response['location']['value']['coordinates']
-    except (KeyError, TypeError) as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Spot {spot_id} is missing expected location data in FIWARE: {str(e)}"
-        )
-
-    update_payload = {
-        "status": {
-            "type": "Property",
-            "value": "occupied"
-        },
+    coords = coords_cache.get(spot_id)
+    if coords is None:
+        try:
+            response = await client.get(f"{ENTITIES_PATH}/{spot_id}")
+            response.raise_for_status()
+            response = orjson.loads(response.content)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
 
-        "occupancyModified": {
-            "type": "Property",
-            "value": {
-                "@type": "DateTime",
-                "@value": "2023-10-27T12:00:00Z" 
-            }
-        }
-    }
+        try:
+            coords = response['location']['value']['coordinates']
+        except (KeyError, TypeError) as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Spot {spot_id} is missing expected location data in FIWARE: {str(e)}"
+            )
+        coords_cache[spot_id] = coords
 
-    url = f"http://localhost:1026/ngsi-ld/v1/entities/{spot_id}/attrs"
+    url = f"{ENTITIES_PATH}/{spot_id}/attrs"
 
     try:
-        response = requests.patch(
+        response = await client.patch(
             url,
-            json=update_payload,
+            content=OCCUPIED_BODY,
             headers={
                 "Content-Type": "application/json",
 
@@ -260,11 +386,13 @@ async def book_parking_spot(booking: BookingConfirmation):
         )
         response.raise_for_status() 
 
-    except requests.exceptions.HTTPError as e:
-        raise HTTPException(status_code=400, detail=f"Failed to update FIWARE: {response.text}")
+    except httpx.HTTPStatusError as e:
+        raise fiware_update_failed(response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Connection Error: {str(e)}")
 
+    invalidate_spots()
+
     try:
         await manager.send_coordinates(spot_id, coords)
     except Exception as e:
@@ -279,13 +407,13 @@ async def book_parking_spot(booking: BookingConfirmation):
     }
 
 @app.post("/parking-garage")
-def create_parking_garage(garage_data: dict = Body(...)):
+async def create_parking_garage(garage_data: dict = Body(...)):
     """
     Registers a new Parking Garage entity in the FIWARE Context Broker.
     """
     try:
-        response = requests.post(
-            ORION_URL,
+        response = await client.post(
+            ENTITIES_PATH,
             json=garage_data,
             headers={
                 "Content-Type": "application/json",
@@ -295,6 +423,9 @@ def create_parking_garage(garage_data: dict = Body(...)):
         )
 
         if response.status_code == 201:
+            # Spot entities are registered through this endpoint too
+            invalidate_spots()
+            coords_cache.pop(garage_data.get("id"), None)
             return {"status": "success", "message": "Parking Garage registered successfully."}
         else:
             raise HTTPException(
@@ -306,52 +437,27 @@ def create_parking_garage(garage_data: dict = Body(...)):
         raise HTTPException(status_code=500, detail=f"Connection Error: {str(e)}")
 
 @app.post("/clear-all-spots")
-def clear_parking_spot():
+async def clear_parking_spot():
     """
-    Finds the best parking spot based on user preferences.
+    Resets every parking spot that isn't already 'free' in the Digital Twin.
     """
 
-    try:
-        response = requests.get(
-            f"{ORION_URL}?type=SmartIndoorParkingSpot",
-            headers={"Accept": "application/ld+json"}
-        )
-        response.raise_for_status()
-        all_spots = response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Could not connect to FIWARE: {str(e)}")
-
-
-    for spot in all_spots:
+    all_spots = await fetch_spots()
 
-        spot_id = spot.get("id")
+    targets = [
+        spot.get("id")
+        for spot in all_spots
+        if get_clean_value(spot.get("status")) != "free"
+    ]
 
-        status = get_clean_value(spot.get("status"))
-        categories = get_clean_value(spot.get("category"))
-
-        if status != "free":
-            update_payload = {
-                    "status": {
-                        "type": "Property",
-                        "value": "free"
-                    },
-
-                    "occupancyModified": {
-                        "type": "Property",
-                        "value": {
-                            "@type": "DateTime",
-                            "@value": "2023-10-27T12:00:00Z" 
-                        }
-                    }
-                }
-
-
-            url = f"http://localhost:1026/ngsi-ld/v1/entities/{spot_id}/attrs"
+    async def free_spot(spot_id):
+        url = f"{ENTITIES_PATH}/{spot_id}/attrs"
 
+        async with orion_write_slots:
             try:
-                response = requests.patch(
+                response = await client.patch(
                     url,
-                    json=update_payload,
+                    content=FREE_BODY,
                     headers={
                         "Content-Type": "application/json",
 
@@ -359,42 +465,40 @@ def clear_parking_spot():
                 )
                 response.raise_for_status() 
 
-            except requests.exceptions.HTTPError as e:
-                raise HTTPException(status_code=400, detail=f"Failed to update FIWARE: {response.text}")
+            except httpx.HTTPStatusError as e:
+                raise fiware_update_failed(response)
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Connection Error: {str(e)}")
 
+    # Let every PATCH settle before invalidating: failing fast would leave the
+    # rest in flight, free to land after a concurrent read re-cached old state.
+    results = await asyncio.gather(
+        *(free_spot(spot_id) for spot_id in targets),
+        return_exceptions=True
+    )
+    # Some spots may have been freed even if another PATCH failed
+    invalidate_spots()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
     return {
         "status": "success", 
         "message": f"{len(all_spots)} Spots are now free."
     }
 
 @app.post("/clear-spot/{spot_id}")
-def clear_single_parking_spot(spot_id: str):
+async def clear_single_parking_spot(spot_id: str):
     """
     Resets a specific parking spot status to 'free' in the Digital Twin.
     """
 
-    update_payload = {
-        "status": {
-            "type": "Property",
-            "value": "free"
-        },
-        "occupancyModified": {
-            "type": "Property",
-            "value": {
-                "@type": "DateTime",
-                "@value": "2023-10-27T12:00:00Z" 
-            }
-        }
-    }
-
-    url = f"http://localhost:1026/ngsi-ld/v1/entities/{spot_id}/attrs"
+    url = f"{ENTITIES_PATH}/{spot_id}/attrs"
 
     try:
-        response = requests.patch(
+        response = await client.patch(
             url,
-            json=update_payload,
+            content=FREE_BODY,
             headers={
                 "Content-Type": "application/json",
             }
@@ -405,11 +509,15 @@ def clear_single_parking_spot(spot_id: str):
 
         response.raise_for_status() 
 
-    except requests.exceptions.HTTPError as e:
-        raise HTTPException(status_code=400, detail=f"Failed to update FIWARE: {response.text}")
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        raise fiware_update_failed(response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Connection Error: {str(e)}")
 
+    invalidate_spots()
+
     return {
         "status": "success", 
         "message": f"Spot {spot_id} is now free and available for new bookings."
@@ -417,33 +525,48 @@ def clear_single_parking_spot(spot_id: str):
 
 
 @app.delete("/delete-garage/{garage_id:path}")
-def delete_garage(garage_id: str):
-    HEADERS = {
-    "Accept": "application/ld+json"
-    }
+async def delete_garage(garage_id: str):
     try:
         # 1. Query spots linked to the garage
-        query_url = f"{ORION_URL}/entities"
         params = {
             "type": "SmartIndoorParkingSpot",
             "q": f"refParkingGarage=={garage_id}"
         }
 
-        resp = requests.get(query_url, headers=HEADERS, params=params)
+        resp = await client.get(ENTITIES_PATH, params=params)
         resp.raise_for_status()
-        spots = resp.json()
+        spots = orjson.loads(resp.content)
 
+        # 2. Delete all spots in one batch request
+        spot_ids = [spot["id"] for spot in spots]
         deleted_spots = []
-
-        # 2. Delete each spot
-        for spot in spots:
-            spot_id = spot["id"]
-            del_resp = requests.delete(f"{ORION_URL}/entities/{spot_id}")
+        if spot_ids:
+            del_resp = await client.post(
+                BATCH_DELETE_PATH,
+                content=orjson.dumps(spot_ids),
+                headers={"Content-Type": "application/json"}
+            )
             if del_resp.status_code == 204:
-                deleted_spots.append(spot_id)
+                # Every entity in the batch was deleted
+                deleted_spots = spot_ids
+            elif del_resp.status_code == 207:
+                # Partial success: Orion lists the ids it did delete
+                try:
+                    deleted_spots = orjson.loads(del_resp.content).get("success", [])
+                except (ValueError, AttributeError):
+                    # Some spots may be gone, but we can't tell which
+                    invalidate_spots()
+                    for spot_id in spot_ids:
+                        coords_cache.pop(spot_id, None)
+                    raise
+            else:
+                del_resp.raise_for_status()
+        invalidate_spots()
+        for spot_id in deleted_spots:
+            coords_cache.pop(spot_id, None)
 
         # 3. Delete the garage
-        garage_resp = requests.delete(f"{ORION_URL}/entities/{garage_id}")
+        garage_resp = await client.delete(f"{ENTITIES_PATH}/{garage_id}")
         if garage_resp.status_code != 204:
             raise HTTPException(
                 status_code=garage_resp.status_code,
@@ -457,5 +580,6 @@ def delete_garage(garage_id: str):
             "spotsDeletedCount": len(deleted_spots)
         }
 
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError, AttributeError) as e:
+        # ValueError/AttributeError: Orion sent a body we couldn't read
         raise HTTPException(status_code=500, detail=str(e))
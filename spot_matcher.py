@@ -0,0 +1,76 @@
+"""
+Spot matching for /find-spot, kept free of FastAPI/httpx imports so it can
+be compiled ahead of time with mypyc (see README). Behaves the same whether
+compiled or imported as plain Python.
+"""
+from typing import Any, Final, Optional
+
+# Special spot categories used by the Smart Data Model
+EV: Final = "forElectricCharging"
+DIS: Final = "forDisabled"
+FEM: Final = "forWomen"
+
+
+def best_spot(
+    spots: list[dict[str, Any]], need_ev: bool, need_dis: bool, need_fem: bool
+) -> tuple[Optional[dict[str, Any]], int]:
+    """
+    Returns the free spot whose special categories exactly match the request,
+    preferring the lowest weight and then the lowest spot number, together
+    with its weight. Returns (None, 4) when nothing matches.
+    """
+    need = int(need_ev) | (int(need_dis) << 1) | (int(need_fem) << 2)
+
+    best: Optional[dict[str, Any]] = None
+    min_weight = 4  # one more than the highest possible weight (3 categories)
+    min_spot_number: float = float("inf")
+
+    for spot in spots:
+
+        # NGSI-LD attributes are unwrapped inline rather than through a helper
+        # call, since this runs once per spot.
+        status: Any = spot.get("status")
+        if isinstance(status, dict):
+            status = status.get("value")
+        if status != "free":
+            continue
+
+        categories: Any = spot.get("category")
+        if isinstance(categories, dict):
+            categories = categories.get("value")
+        # Orion can return category as a single string OR a list — normalize it
+        if isinstance(categories, str):
+            categories = (categories,)
+        cats = frozenset(categories or ())
+
+        # One bit per special category: EV = 1, disabled = 2, women = 4
+        mask = int(EV in cats) | (int(DIS in cats) << 1) | (int(FEM in cats) << 2)
+        spot_weight = mask.bit_count()
+
+        # A spot matches only if EACH special category either:
+        #   - was requested and the spot has it, or
+        #   - was NOT requested and the spot does NOT have it.
+        # This is what makes the three categories behave symmetrically:
+        # requesting "general" (nothing) should never match an EV spot,
+        # a women's spot, or an accessible spot — and requesting "women only"
+        # should never match a women's spot that's ALSO an EV spot.
+        if mask != need or spot_weight > min_weight:
+            continue
+
+        # Keep a running minimum instead of collecting candidates first.
+        # Ties go to the lowest spot number, so the whole list is scanned
+        # even once a zero-weight spot has been seen.
+        raw_spot_number: Any = spot.get("spotNumber")
+        if isinstance(raw_spot_number, dict):
+            raw_spot_number = raw_spot_number.get("value")
+        spot_number: float
+        try:
+            spot_number = float(int(raw_spot_number))
+        except (TypeError, ValueError):
+            spot_number = float("inf")
+        if spot_weight < min_weight or spot_number < min_spot_number:
+            min_weight = spot_weight
+            min_spot_number = spot_number
+            best = spot
+
+    return best, min_weight